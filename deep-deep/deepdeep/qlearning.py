@@ -79,10 +79,11 @@ from typing import Callable, List, Tuple, Any, Optional
 
 import numpy as np  # type: ignore
 from scipy import sparse  # type: ignore
+from scipy.sparse import _sparsetools  # type: ignore
 import sklearn.base  # type: ignore
 from sklearn.linear_model import SGDRegressor  # type: ignore
 
-from deepdeep.utils import log_time, csr_nbytes
+from deepdeep.utils import log_time, csr_nbytes, vstack_rows
 
 
 class QLearner:
@@ -239,7 +240,10 @@ class QLearner:
             if self.on_model_changed is not None:
                 self.on_model_changed()
 
-    def predict(self, AS: sparse.csr_matrix, online: bool=False) -> np.ndarray:
+    def predict(self,
+                AS: sparse.csr_matrix,
+                online: bool=False,
+                out: Optional[np.ndarray]=None) -> np.ndarray:
         """
         Compute Q(s, a) function for all state-action pairs.
 
@@ -256,6 +260,11 @@ class QLearner:
             Whether to use online Q function (default is False, meaning
             target Q function is used for predictions).
 
+        out : ndarray, optional
+            Pre-allocated buffer (of AS.dtype) to write scores into;
+            must have at least AS.shape[0] elements. Passing a reusable
+            buffer avoids allocating a fresh score array on every call.
+
         Returns
         -------
         y : array-like, shape (n_rows,)
@@ -263,9 +272,24 @@ class QLearner:
 
         """
         clf = self.clf_target if not online else self.clf_online
+        n_rows = AS.shape[0]
         if clf.coef_ is None:
-            return np.ones(AS.shape[0]) * self.initial_predictions
-        return clf.predict(AS)
+            if out is None:
+                return np.ones(n_rows) * self.initial_predictions
+            y = out[:n_rows]
+            y.fill(self.initial_predictions)
+            return y
+        if out is None:
+            return clf.predict(AS)
+        w = clf.coef_.ravel()
+        if w.dtype != AS.dtype:
+            w = w.astype(AS.dtype)
+        y = out[:n_rows]
+        y.fill(float(clf.intercept_[0]))
+        # csr_matvec accumulates A*w into y without allocating a result
+        _sparsetools.csr_matvec(n_rows, AS.shape[1], AS.indptr, AS.indices,
+                                AS.data, w, y)
+        return y
 
     def predict_one(self, as_, online=False) -> float:
         """
@@ -304,7 +328,9 @@ class QLearner:
         sample = self.memory.sample(sample_size)
         as_t_list, AS_t1_list, r_t1_list = zip(*sample)
         rewards = np.asarray(r_t1_list)
-        X = sparse.vstack(as_t_list)
+        # as_t vectors are 1-row CSR matrices; vstack_rows stitches
+        # their components directly, skipping sparse.vstack overhead
+        X = vstack_rows(list(as_t_list))
         Q_t1_vector = self._get_Q_t1_values(rewards.shape, AS_t1_list)
         y = rewards + self.gamma * Q_t1_vector
         self.clf_online.partial_fit(X, y)
@@ -29,7 +29,7 @@ from typing import (
 import numpy as np  # type: ignore
 import scrapy  # type: ignore
 
-from deepdeep.utils import softmax, log_time, csr_nbytes
+from deepdeep.utils import softmax, log_time, csr_nbytes, csr_row
 
 
 FLOAT_PRIORITY_MULTIPLIER = 10000
@@ -39,6 +39,14 @@ def score_to_priority(score: float) -> int:
     return int(score * FLOAT_PRIORITY_MULTIPLIER)
 
 
+def scores_to_priorities(scores: np.ndarray) -> np.ndarray:
+    """
+    Vectorized :func:`score_to_priority`: convert an array of scores
+    with a single ufunc call instead of a Python call per score.
+    """
+    return (scores * FLOAT_PRIORITY_MULTIPLIER).astype(np.int64)
+
+
 def priority_to_score(prio: int) -> float:
     return prio / FLOAT_PRIORITY_MULTIPLIER
 
@@ -376,6 +384,10 @@ class BalancedPriorityQueue:
 
 def request_nbytes(request):
     if hasattr(request, 'meta'):
-        return csr_nbytes(request.meta.get('link_vector'))
+        ref = request.meta.get('link_vector')
+        if ref is None:
+            return 0
+        matrix, row = ref
+        return csr_nbytes(csr_row(matrix, row))
     else:
         return 0
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+import collections
+import hashlib
+import itertools
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, Tuple, Union, Optional, List, Iterator, Set
 import abc
@@ -9,7 +14,6 @@ import logging
 from weakref import WeakKeyDictionary
 
 import psutil  # type: ignore
-import tqdm  # type: ignore
 import joblib  # type: ignore
 import numpy as np  # type: ignore
 import scipy.sparse as sp  # type: ignore
@@ -20,15 +24,22 @@ from scrapy.statscollectors import StatsCollector  # type: ignore
 from scrapy_cdr.utils import text_cdr_item  # type: ignore
 import tensorboard_logger  # type: ignore
 
+try:
+    import lz4  # type: ignore  # noqa: F401
+except ImportError:
+    lz4 = None
+
 from deepdeep.queues import (
     BalancedPriorityQueue,
     RequestsPriorityQueue,
     score_to_priority,
+    scores_to_priorities,
     priority_to_score, FLOAT_PRIORITY_MULTIPLIER)
 from deepdeep.scheduler import Scheduler
 from deepdeep.spiders._base import BaseSpider
 from deepdeep.qlearning import QLearner
-from deepdeep.utils import set_request_domain, get_domain, log_time, chunks
+from deepdeep.utils import (
+    set_request_domain, get_domain, log_time, chunks, csr_row, vstack_rows)
 from deepdeep.vectorizers import LinkVectorizer, PageVectorizer
 from deepdeep.goals import BaseGoal
 from deepdeep.metrics import ndcg_score
@@ -54,7 +65,9 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         'eps', 'balancing_temperature', 'gamma',
         'clf_alpha', 'clf_penalty',
         'replay_sample_size', 'replay_maxsize', 'replay_maxlinks',
+        'link_feat_cache_maxsize',
         'domain_queue_maxsize', 'steps_before_switch',
+        'rescheduling_coef_threshold',
         'checkpoint_path', 'checkpoint_interval', 'checkpoint_latest',
         'baseline', 'export_cdr',
     }
@@ -109,6 +122,11 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     # every `steps_before_switch` steps
     steps_before_switch = 100
 
+    # request priorities are not recalculated if L2 norm of target Q
+    # function coefficients changed by less than this relative amount
+    # since the last rescheduling; set to 0 to always recalculate
+    rescheduling_coef_threshold = 0.02
+
     # how many examples to fetch from experience replay on each iteration
     replay_sample_size = 300
 
@@ -127,6 +145,10 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
 
     domain_queue_maxsize = 0  # no limit by default
 
+    # max number of link feature vectors kept in a cache;
+    # set to 0 to disable caching
+    link_feat_cache_maxsize = 200000
+
     # current model is saved every checkpoint_interval timesteps
     checkpoint_interval = 1000
 
@@ -154,12 +176,17 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         self.use_full_page_urls = bool(int(self.use_full_page_urls))
         self.double = int(self.double)
         self.steps_before_switch = int(self.steps_before_switch)
+        self.rescheduling_coef_threshold = float(self.rescheduling_coef_threshold)
+        self._last_recalc_norm = 0.0
         self.replay_sample_size = int(self.replay_sample_size)
         self.replay_maxsize = int(self.replay_maxsize)
         self.replay_maxlinks = int(self.replay_maxlinks)
         self.clf_penalty = str(self.clf_penalty)
         self.clf_alpha = float(self.clf_alpha)
         self.domain_queue_maxsize = int(self.domain_queue_maxsize)
+        self.link_feat_cache_maxsize = int(self.link_feat_cache_maxsize)
+        self._link_feat_cache = collections.OrderedDict()  # type: collections.OrderedDict
+        self._score_buf = np.empty(0, dtype=np.float32)
         self.baseline = bool(int(self.baseline))
         self.Q = QLearner(
             steps_before_switch=self.steps_before_switch,
@@ -233,7 +260,32 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         return self._reward_cache[response]
 
     def is_seed(self, r: Union[scrapy.Request, Response]) -> bool:
-        return 'link_vector' not in r.meta
+        # requests created by _links_to_requests carry an explicit flag;
+        # anything else (seed urls) defaults to True. A precomputed bool
+        # is cheaper than probing meta for 'link_vector' in hot loops.
+        return r.meta.get('_is_seed', True)
+
+    @staticmethod
+    def _link_vector(r: Union[scrapy.Request, Response],
+                     copy: bool=False) -> Optional[sp.csr_matrix]:
+        """
+        Materialize the link vector of a request or response.
+
+        meta stores a lazy ``(matrix, row)`` reference, so requests
+        which are dropped by the dupefilter never pay for row extraction.
+        The per-page matrix stays alive exactly as long as some request
+        still references it.
+
+        By default the returned row is a zero-copy view. Pass
+        ``copy=True`` when the row is kept long-term (e.g. in experience
+        replay memory): a view would pin the whole per-page matrix.
+        """
+        ref = r.meta.get('link_vector')
+        if ref is None:
+            return None
+        matrix, row = ref
+        v = csr_row(matrix, row)
+        return v.copy() if copy else v
 
     def update_node(self, response: Response, data: Dict) -> None:
         """ Store extra information in crawl graph node """
@@ -288,7 +340,7 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             # bad seed
             return [], 0
 
-        as_t = response.meta.get('link_vector')
+        as_t = self._link_vector(response, copy=True)
 
         if not hasattr(response, 'text'):
             # learn to avoid non-html responses
@@ -302,14 +354,17 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
 
         page_vector = self._page_vector(response) if self.use_pages else None
         links = self._extract_links(response)
-        links_matrix = self.link_vectorizer.transform(links) if links else None
+        links_matrix = self._vectorize_links(links) if links else None
         links_matrix = self.Q.join_As(links_matrix, page_vector)
         if links_matrix is not None:
-            links_matrix = links_matrix.astype(np.float32)  # saving memory
+            # saving memory; with float32 vectorizers this is a no-op
+            links_matrix = links_matrix.astype(np.float32, copy=False)
 
         reward = 0
         if not self.is_seed(response):
-            reward = self.goal.get_reward(response)
+            # get_reward caches per-response, so the value is shared
+            # with _debug_expected_vs_got
+            reward = self.get_reward(response)
             self.update_node(response, {'reward': reward})
             self.total_reward += reward
             self.rewards.append(reward)
@@ -326,6 +381,53 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         return (list(self._links_to_requests(response, links, links_matrix)),
                 reward)
 
+    def _scores_out(self, n: int) -> np.ndarray:
+        """
+        A reusable buffer for :meth:`QLearner.predict` output;
+        grown geometrically to avoid allocating a score array per call.
+        """
+        if self._score_buf.shape[0] < n:
+            size = max(n, 2 * self._score_buf.shape[0])
+            self._score_buf = np.empty(size, dtype=np.float32)
+        return self._score_buf
+
+    def _vectorize_links(self, links: List[Dict]) -> sp.csr_matrix:
+        """
+        Compute feature vectors for links, reusing cached rows for links
+        seen before: navigation links recur on every page of a site,
+        and re-tokenizing them is a large part of link processing cost.
+        """
+        if not self.link_feat_cache_maxsize:
+            return self.link_vectorizer.transform(links)
+        cache = self._link_feat_cache
+        keys = [self._link_fingerprint(link) for link in links]
+        miss_idx = [i for i, key in enumerate(keys) if key not in cache]
+        if miss_idx:
+            new_matrix = self.link_vectorizer.transform(
+                [links[i] for i in miss_idx])
+            for row, i in enumerate(miss_idx):
+                cache[keys[i]] = csr_row(new_matrix, row)
+        rows = [cache[key] for key in keys]
+        while len(cache) > self.link_feat_cache_maxsize:  # FIFO eviction
+            cache.popitem(last=False)
+        return vstack_rows(rows)
+
+    def _link_fingerprint(self, link: Dict) -> bytes:
+        """ A hash of link dict fields the link vectorizer can use """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(link['url'].encode())
+        h.update(b'\0')
+        h.update(link.get('inside_text', '').encode())
+        h.update(b'\0')
+        h.update(link.get('attrs', {}).get('title', '').encode())
+        h.update(b'\0')
+        same_domain = link.get('domain_from') == link.get('domain_to')
+        h.update(b'1' if same_domain else b'0')
+        if self.use_page_urls or self.use_full_page_urls:
+            h.update(b'\0')
+            h.update(link.get('page_url', '').encode())
+        return h.digest()
+
     def _extract_links(self, response: TextResponse) -> List[Dict]:
         """ Return a list of all unique links on a page """
         return list(self.le.iter_link_dicts(
@@ -343,20 +445,28 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         indices_and_links = list(self.le.deduplicate_links_enumerated(links))
         if not indices_and_links:
             return
-        indices, links_to_follow = zip(*indices_and_links)
-        AS = links_matrix[list(indices)]
-        scores = self.Q.predict(AS)
-
-        for link, v, score in zip(links_to_follow, AS, scores):
+        # a contiguous int32 index array hits scipy's fast row-selection
+        # path; indexing with a list of Python ints converts per element
+        idxs = np.fromiter((idx for idx, _ in indices_and_links),
+                           dtype=np.int32, count=len(indices_and_links))
+        links_to_follow = [link for _, link in indices_and_links]
+        AS = links_matrix[idxs]
+        scores = self.Q.predict(AS, out=self._scores_out(AS.shape[0]))
+
+        AS.sort_indices()
+        priorities = scores_to_priorities(scores).tolist()
+
+        for i, link in enumerate(links_to_follow):
             url = link['url']
             next_domain = get_domain(url)
             meta = {
-                'link_vector': v,
+                # lazy reference, see _link_vector
+                'link_vector': (AS, i),
+                '_is_seed': False,
                 # 'link': link,  # turn it on for debugging
                 'scheduler_slot': next_domain,
             }
-            priority = score_to_priority(score)
-            req = scrapy.Request(url, priority=priority, meta=meta)
+            req = scrapy.Request(url, priority=priorities[i], meta=meta)
             set_request_domain(req, next_domain)
             yield req
 
@@ -389,12 +499,24 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     def on_model_changed(self):
         # TODO: this should pause engine first, in order
         # for download timeouts to work correctly
-        if self.steps_before_reschedule <= 0:
+        if self.steps_before_reschedule <= 0 and self._coef_changed_enough():
             num_updated = self.recalculate_request_priorities()
             self.steps_before_reschedule = self._steps_before_rescheduling(num_updated)
+            self._last_recalc_norm = self.Q.coef_norm(online=False)
         logging.info("{} steps left before next re-scheduling"
                      .format(self.steps_before_reschedule))
 
+    def _coef_changed_enough(self) -> bool:
+        """
+        Whether target Q function coefficients moved enough since the
+        last rescheduling for request priorities to change the ordering.
+        """
+        if not self.rescheduling_coef_threshold:
+            return True
+        norm = self.Q.coef_norm(online=False)
+        delta = abs(norm - self._last_recalc_norm)
+        return delta > self.rescheduling_coef_threshold * max(norm, 1e-9)
+
     def close_finished_queues(self):
         for slot in self.scheduler.queue.get_active_slots():
             if self.goal.is_achieved_for(domain=slot):
@@ -405,37 +527,81 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         if self.baseline:
             return 0
 
+        # Collect link vectors from all slots first, so that Q values
+        # for the whole queue are predicted in one pass; per-slot predict
+        # calls waste time on many small batches.
+        slot_requests = []  # type: List[Tuple[str, List[scrapy.Request]]]
+        vectors = []
+        slots = self.scheduler.queue.get_active_slots()
+        last_log = time.monotonic()
+        for num, slot in enumerate(slots, 1):
+            queue = self.scheduler.queue.get_queue(slot)
+            requests = list(queue.iter_requests())
+            slot_requests.append((slot, requests))
+            vectors.extend(self._link_vector(r) for r in requests
+                           if not self.is_seed(r))
+            # a progress bar here (tqdm) adds per-slot overhead and spams
+            # stderr on every training step; log a throttled counter instead
+            if time.monotonic() - last_log > 1.0:
+                self.logger.info("rescheduling: {}/{} slots collected"
+                                 .format(num, len(slots)))
+                last_log = time.monotonic()
+
+        if vectors:
+            # each batch gets a disjoint slice of the shared score
+            # buffer, so threaded prediction stays safe and the scores
+            # land contiguously without a final concatenate
+            buf = self._scores_out(len(vectors))
+
+            def predict_batch(args: Tuple[int, List]) -> np.ndarray:
+                start, batch = args
+                return self.Q.predict(vstack_rows(batch),
+                                      out=buf[start:start + len(batch)])
+
+            batches = list(zip(itertools.count(0, 4096), chunks(vectors, 4096)))
+            n_workers = min(len(batches), os.cpu_count() or 1)
+            if n_workers > 1:
+                # scipy's sparse matrix-vector product releases the GIL,
+                # so chunks can be predicted in parallel threads
+                with ThreadPoolExecutor(n_workers) as executor:
+                    for _ in executor.map(predict_batch, batches):
+                        pass
+            else:
+                for args in batches:
+                    predict_batch(args)
+            scores = buf[:len(vectors)]
+            all_priorities = scores_to_priorities(scores)
+        else:
+            all_priorities = np.empty(0, dtype=np.int64)
+
         scores_new = []
         scores_old = []
+        offset = 0  # consumed part of all_priorities
 
         def request_priorities(requests: List[scrapy.Request]) -> List[int]:
-            priorities = np.ndarray(len(requests), dtype=int)
-            old_priorities = np.zeros_like(priorities)
-            vectors, indices = [], []
-            for idx, request in enumerate(requests):
-                old_priorities[idx] = request.priority
-                if self.is_seed(request):
-                    priorities[idx] = request.priority
-                    continue
-                vectors.append(request.meta['link_vector'])
-                indices.append(idx)
-            if vectors:
-                scores = np.concatenate([self.Q.predict(sp.vstack(batch))
-                                         for batch in chunks(vectors, 4096)])
-                priorities[indices] = scores * FLOAT_PRIORITY_MULTIPLIER
+            nonlocal offset
+            n = len(requests)
+            old_priorities = np.fromiter((r.priority for r in requests),
+                                         dtype=np.int64, count=n)
+            seed_mask = np.fromiter((self.is_seed(r) for r in requests),
+                                    dtype=bool, count=n)
+            n_links = n - int(seed_mask.sum())
+            priorities = np.empty(n, dtype=np.int64)
+            priorities[seed_mask] = old_priorities[seed_mask]
+            priorities[~seed_mask] = all_priorities[offset:offset + n_links]
+            offset += n_links
 
             # keep scores in order to compute metrics later
             scores_new.append(priorities / FLOAT_PRIORITY_MULTIPLIER)
             scores_old.append(old_priorities / FLOAT_PRIORITY_MULTIPLIER)
 
-            # convert priorities to Python ints because scrapy.Request
-            # doesn't support numpy int types
-            priorities = [p.item() for p in priorities]
-
             # TODO: use _log_promising_link or remove it
-            return priorities
 
-        for slot in tqdm.tqdm(self.scheduler.queue.get_active_slots()):
+            # tolist() of an integer array gives Python ints;
+            # scrapy.Request doesn't support numpy int types
+            return priorities.tolist()
+
+        for slot, requests in slot_requests:
             queue = self.scheduler.queue.get_queue(slot)
             queue.update_all_priorities(request_priorities)
 
@@ -576,7 +742,10 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     def _debug_expected_vs_got(self, response: Response):
         if 'link' not in response.meta:
             return
-        reward = self.goal.get_reward(response)
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            # don't compute the reward just for a suppressed message
+            return
+        reward = self.get_reward(response)
         self.logger.debug("\nGOT {:0.4f} (expected return was {:0.4f}) {}\n{}".format(
             reward,
             priority_to_score(response.request.priority),
@@ -632,9 +801,12 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             'page_vectorizer': self.page_vectorizer,
             '_params': self.get_params(),
         }
+        # lz4 compresses dense numpy buffers several times faster than
+        # zlib at a similar ratio, shortening checkpoint stalls
+        compress = ('lz4', 1) if lz4 is not None else ('zlib', 1)
         self.Q.pickle_memory = save_experience_replay
         try:
-            joblib.dump(data, str(path), compress=3)
+            joblib.dump(data, str(path), compress=compress)
         finally:
             self.Q.pickle_memory = False
         self._save_params_json()
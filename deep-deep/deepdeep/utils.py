@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import logging
+import sys
 import time
 import itertools
 import functools
 import collections
+from typing import List
 from urllib.parse import unquote_plus, urlsplit
 
 import numpy as np  # type: ignore
@@ -31,8 +33,12 @@ def dict_aggregate_max(*dicts):
     return res
 
 
+@functools.lru_cache(maxsize=100000)
 def get_domain(url: str) -> str:
-    return tldextract.extract(url).registered_domain.lower()
+    # the same domain is extracted from many URLs; interning makes all
+    # of them share one string object (queued requests keep domains in
+    # meta, so this saves memory and speeds up dict lookups by slot)
+    return sys.intern(tldextract.extract(url).registered_domain.lower())
 
 
 def get_response_domain(response):
@@ -146,6 +152,46 @@ def canonicalize_url(url: str) -> str:
     return _canonicalize_url(url)
 
 
+def csr_row(m: csr_matrix, i: int) -> csr_matrix:
+    """
+    Return i-th row of a CSR matrix as a 1-row CSR matrix.
+
+    Faster than ``m[i]`` or ``m.getrow(i)``: row data is sliced through
+    indptr, without a fancy-indexing pass, and the result is a view
+    into the original matrix.
+    """
+    start, stop = m.indptr[i], m.indptr[i + 1]
+    return csr_matrix(
+        (m.data[start:stop], m.indices[start:stop],
+         np.array([0, stop - start])),
+        shape=(1, m.shape[1]), copy=False)
+
+
+def vstack_rows(rows: List[csr_matrix]) -> csr_matrix:
+    """
+    Stack 1-row CSR matrices into a single CSR matrix.
+
+    It does the same as ``scipy.sparse.vstack``, but stores link vectors
+    column-wise (data, indices and indptr are concatenated directly),
+    skipping per-matrix validation and dtype promotion; this is much
+    faster for long lists of rows.
+
+    >>> rows = [csr_matrix([[1., 0.]]), csr_matrix([[0., 2.]])]
+    >>> vstack_rows(rows).toarray()
+    array([[ 1.,  0.],
+           [ 0.,  2.]])
+    """
+    data = np.concatenate([row.data for row in rows])
+    indices = np.concatenate([row.indices for row in rows])
+    counts = np.fromiter((row.indptr[-1] for row in rows),
+                         dtype=np.int64, count=len(rows))
+    indptr = np.empty(len(rows) + 1, dtype=np.int64)
+    indptr[0] = 0
+    np.cumsum(counts, out=indptr[1:])
+    return csr_matrix((data, indices, indptr),
+                      shape=(len(rows), rows[0].shape[1]), copy=False)
+
+
 def csr_nbytes(m: csr_matrix) -> int:
     if m is not None:
         return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
@@ -38,6 +38,7 @@ def LinkVectorizer(use_url: bool=False,
             # ngram_range=(1, 2),
             analyzer='char',
             ngram_range=(3, 5),
+            dtype=np.float32,
         )
         vectorizers.append(text_vec)
 
@@ -68,6 +69,7 @@ def _url_vectorizer(preprocessor):
         binary=True,
         analyzer='char',
         ngram_range=(4, 5),
+        dtype=np.float32,
     )
 
 
@@ -142,7 +144,7 @@ def _clean_page_url_keep_domain(link: Dict) -> str:
 def _same_domain_feature(links):
     return np.asarray([
         link['domain_from'] == link['domain_to'] for link in links
-    ]).reshape((-1, 1))
+    ], dtype=np.float32).reshape((-1, 1))
 
 
 def _html_text_lower(html: str) -> str: